@@ -9,9 +9,10 @@ import matplotlib
 matplotlib.use('Qt5Agg')
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
 
 import numpy as np
-import mutils, wavio, os
+import mutils, os, math, shutil, tempfile, atexit, pathlib
 
 
 class PyQtLayout(QWidget):
@@ -30,6 +31,8 @@ class PyQtLayout(QWidget):
         list of WaveInfo objects, each representing a wave the user has added.
     rate: int
         sample rate for generating waves.
+    final_vec : numpy.ndarray
+        sum of all the waves in wave_objects, max_dur*rate samples long. None until a wave is added.
     """
     def __init__(self):
         """
@@ -46,18 +49,25 @@ class PyQtLayout(QWidget):
         self.wave_objects = []
         self.rate = 44100
         self.plot_all = False
+        #running sum of the waves and the time axis for it, and the fft of the sum which is rebuilt by _recompute_signal when wave_objects changes
+        self.final_vec = None
+        self._sum = mutils.aligned_empty(0, np.float32)
+        self._grow_buffers(self.max_dur*self.rate)
+        self._waves_dirty = False
+        self._audio_dirty = False
+        #set while an update_plot call is waiting on the event loop, or waiting for the canvas to be shown
+        self._update_pending = False
+        self._update_deferred = False
         
-        #get directory we can write to, create if not present
-        self.wavedir = mutils.get_datadir()
-        try: 
-            self.wavedir.mkdir() 
-        except FileExistsError: 
-            pass
+        #temporary directory for the generated .wav files, removed when the app exits
+        self.wavedir = pathlib.Path(tempfile.mkdtemp(prefix="WavePlayground"))
+        atexit.register(shutil.rmtree, self.wavedir, ignore_errors=True)
         
         #Widget instantiation for 
         self.waveTable = QTableWidget()
         self.canvas = MplCanvas(self, width=5, height=6, dpi=100)
         self.toolbar = NavigationToolbar(self.canvas, self)
+        self.canvas.axes.callbacks.connect('xlim_changed', self._set_wave_data)
         self.player = QMediaPlayer()
 
         self.UI()
@@ -77,68 +87,156 @@ class PyQtLayout(QWidget):
         """
         Deletes wave files and clears everything else.
         """
-        files = self.wavedir.glob("*.wav")
+        #the directory only holds our wave files, so it's removed and recreated as a whole
+        shutil.rmtree(self.wavedir, ignore_errors=True)
         try:
-            for f in files:
-                os.remove(f)
+            os.makedirs(self.wavedir, exist_ok=True)
         except OSError as e:
             print(e)
         finally:
             self.wave_objects = []
+            self._sum.fill(0)
+            self._waves_dirty = True
             self.update_plot()
             self.tableSetup()
 
     def update_plot(self):
         """
-        Updates the two plots.
+        Schedules recomputing the summed wave, updating the two plots, and saving and playing the result. Any
+        further calls before control gets back to the event loop are folded into the same update.
         """
+        if self._update_pending:
+            return
+        self._update_pending = True
+        qc.QTimer.singleShot(0, self._do_update)
+
+    def _do_update(self):
+        self._update_pending = False
+        if not self.canvas.isVisible():
+            # nothing on screen to draw into, showEvent runs the update once there is
+            self._update_deferred = True
+            return
+        self._recompute_signal()
+        self._redraw()
+        self._write_and_play()
 
-        # clear axes for both subplots and reset some params
-        self.canvas.axes.cla()
-        self.canvas.axes_fft.cla()
-        self.canvas.setAxParams()
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self._update_deferred:
+            self._update_deferred = False
+            self.update_plot()
+
+    def _recompute_signal(self):
+        """
+        Takes the fft of the running sum of the waves. Does nothing unless the wave list changed since the last call.
+        """
+        if not self._waves_dirty:
+            return
+        self._waves_dirty = False
+        self._audio_dirty = True
 
         # check to see if the user has added any waves
-        if self.wave_objects:
-            # creates the t array, evenly spaced values going from 0 to self.max_dur. Total number of values generated is max_dur*rate
-            max_t = np.linspace(0, self.max_dur, self.max_dur*self.rate, endpoint=False)
-            #set up a 0 vector of appropriate length, wave accumulator
-            final_vec = 0 * max_t
-            for v in self.wave_objects:
-                # generates the wave from the params of the current WaveInfo object 
-                current = v.gen_wave(self.rate)
-
-                #if the current wave is shorter than the accumulator, pad it on the right with 0's
-                #we don't check the other case as final_vec is built using the maximum duration of all present WaveInfo objects
-                if (current.shape[0]<final_vec.shape[0]):
-                    current = np.pad(current, (0, final_vec.shape[0]-current.shape[0]))
-                if (self.plot_all):
-                    self.canvas.axes.plot(max_t, current)
-                #add to running total
-                final_vec += current
+        if not self.wave_objects:
+            self.final_vec = None
+            return
+        self.final_vec = self._sum
+        #frequency content
+        self.fft_x, self.fft_y = mutils.get_fft(self.rate, self.final_vec)
+
+    def _accumulate(self, wave_obj):
+        """
+        Adds a single wave into the running sum, so adding a wave only costs that wave rather than all of them.
+        """
+        n_total = self.max_dur*self.rate
+        if self._sum.shape[0] < n_total:
+            self._grow_buffers(n_total)
+        #shorter waves only touch the first n samples, so no padding is needed
+        current = wave_obj.gen_wave(self.rate)
+        self._sum[:current.shape[0]] += current
+
+    def _grow_buffers(self, n_total):
+        """
+        Reallocates the sum and time buffers to n_total samples, keeping the sum so far at the front. Both are
+        allocated once per growth and 64 byte aligned so the vector math and fft on them don't need an aligned copy.
+        The sum is float32, like the waves themselves, so it goes to the fft without a conversion. The time axis
+        stays float64.
+        """
+        n_old = self._sum.shape[0]
+        grown = mutils.aligned_empty(n_total, np.float32)
+        grown[:n_old] = self._sum
+        grown[n_old:] = 0
+        self._sum = grown
+        # evenly spaced values going from 0 to self.max_dur. Total number of values generated is max_dur*rate
+        self.max_t = mutils.aligned_empty(n_total)
+        self.max_t[:] = np.arange(n_total)
+        self.max_t /= self.rate
+
+    def _redraw(self, redraw_fft=True):
+        """
+        Updates the two plots from the last computed signal. When the fft hasn't changed only the time axis' lines
+        are repainted.
+        """
+        # the line artists are reused, only their data changes
+        self._set_wave_data()
+        if self.final_vec is None:
+            self.canvas.fft_line.set_data([], [])
+        else:
+            #plot the frequency content, thinned out to roughly the number of points the axis can show
+            self.canvas.fft_line.set_data(*mutils.decimate_peaks(self.fft_x, self.fft_y))
+
+        if not redraw_fft:
+            self.canvas.blit_waves()
+            return
+        # the time axis keeps its limits (zoomed or not), the fft axis is rescaled to fit its data
+        self.canvas.axes_fft.relim()
+        self.canvas.axes_fft.autoscale()
+        #redraw the plots once control returns to the event loop. repeated requests before then only draw once
+        self.canvas.draw_idle()
+
+    def _set_wave_data(self, *args):
+        """
+        Sets the time axis' lines to the samples inside its current x limits, so the rest aren't handed to
+        matplotlib. Also connected to the axis' xlim_changed so zooming and panning with the toolbar refill them.
+        """
+        segments = []
+        if self.final_vec is None:
+            self.canvas.sum_line.set_data([], [])
+        else:
+            x0, x1 = self.canvas.axes.get_xlim()
+            start = min(max(int(np.floor(x0*self.rate)), 0), self.final_vec.shape[0])
+            stop = min(max(int(np.ceil(x1*self.rate)) + 1, start), self.final_vec.shape[0])
             #plot the wave
-            self.canvas.axes.plot(max_t, final_vec)
+            self.canvas.sum_line.set_data(self.max_t[start:stop], self.final_vec[start:stop])
 
-            #plot the frequency content
-            x,y = mutils.get_fft(self.rate, final_vec)
-            self.canvas.axes_fft.plot(x, y)
-            
-            #save the file and play it
+            # every individual wave goes into one collection, drawn as a single artist.
+            # a single wave is the same curve as the sum, so it isn't drawn twice
+            if self.plot_all and len(self.wave_objects) > 1:
+                for v in self.wave_objects:
+                    current = v.gen_wave(self.rate)[start:stop]
+                    segments.append(np.column_stack((self.max_t[start:start + current.shape[0]], current)))
+        self.canvas.wave_coll.set_segments(segments)
+
+    def _write_and_play(self):
+        """
+        Saves the last computed signal to a .wav file and plays it. The file is only rewritten when the signal changed.
+        """
+        if self.final_vec is None:
+            return
+        if self._audio_dirty:
             file_end = "wave_sum_{}.wav".format(str(len(self.wave_objects)))
             self.current_wave = self.wavedir / file_end
             try:
-                wavio.write(str(self.current_wave), final_vec, self.rate, sampwidth=3)
+                mutils.write_wav24(self.current_wave, self.rate, self.final_vec)
+                self._audio_dirty = False
             except OSError as e:
                 print(e)
-                pass
-            self.play_audio_file()
-        #redraw the plots
-        self.canvas.draw()
-    
+        self.play_audio_file()
+
     def plot_all_toggle(self):
         cbutton = self.sender()
         self.plot_all = cbutton.isChecked()
-        self.update_plot()
+        #only the individual wave lines change here, the sum, fft and audio stay the same
+        self._redraw(redraw_fft=False)
  
     def UI(self):
         """
@@ -209,54 +307,122 @@ class PyQtLayout(QWidget):
 
     def addWave(self):
         try:
-            frequency = float(eval(self.lineFields['Freq'].text()))
+            frequency = float(self.lineFields['Freq'].text())
             duration = int(self.lineFields['Duration'].text())
             shape = self.lineFields['waveshape'].currentText()
-            amplitude = float(eval(self.lineFields['Amplitude'].text()))
+            amplitude = float(self.lineFields['Amplitude'].text())
         except:
             return
+        #float() takes nan and inf, which would poison the running sum until a reset
+        if not (math.isfinite(frequency) and math.isfinite(amplitude)):
+            return
         if (duration > self.max_dur):
             self.max_dur = duration
         
-        self.wave_objects.append(mutils.WaveInfo(shape, duration, frequency, amplitude))
+        wave_obj = mutils.WaveInfo(shape, duration, frequency, amplitude)
+        self.wave_objects.append(wave_obj)
+        self._accumulate(wave_obj)
+        self._waves_dirty = True
         
         self.update_plot()
-        self.tableSetup()
+        self.tableAppendRow(wave_obj)
+
+    def tableAppendRow(self, w_obj):
+        """
+        Adds a row for a newly added wave, leaving the existing rows alone.
+        """
+        if self.waveTable.columnCount() == 0:
+            # first wave, the columns and headers still need setting up
+            self.tableSetup()
+            return
+        row = self.waveTable.rowCount()
+        # hold off repainting and per cell signals until the whole row is in
+        self.waveTable.setUpdatesEnabled(False)
+        self.waveTable.blockSignals(True)
+        self.waveTable.insertRow(row)
+        self.tableSetRow(row, (w_obj.amplitude, w_obj.duration, w_obj.freq, w_obj.shape))
+        # widen only the columns the new row doesn't fit in, measuring just its cells rather than the whole table
+        opt = self.waveTable.viewOptions()
+        delegate = self.waveTable.itemDelegate()
+        grid = 1 if self.waveTable.showGrid() else 0
+        for n in range(self.waveTable.columnCount()):
+            needed = delegate.sizeHint(opt, self.waveTable.model().index(row, n)).width() + grid
+            if needed > self.waveTable.columnWidth(n):
+                self.waveTable.setColumnWidth(n, needed)
+        self.waveTable.resizeRowToContents(row)
+        self.waveTable.blockSignals(False)
+        self.waveTable.setUpdatesEnabled(True)
 
     def tableSetup(self):
-        nrows = len(self.wave_objects)
-        self.waveTable.setRowCount(nrows)
+        self.waveTable.setRowCount(len(self.wave_objects))
         self.waveTable.setColumnCount(4)
-        tmp_data = {}
-        
-        for i in ['shape', 'duration', 'freq', 'amplitude']:
-            tmp_data[i] = [w_obj.get_kv_dict()[i] for w_obj in self.wave_objects]
-        horHeaders = []
-        for n, key in enumerate(sorted(tmp_data.keys())):
-            horHeaders.append(key)
-            for m, item in enumerate(tmp_data[key]):
-                newitem = QTableWidgetItem(str(item))
-                self.waveTable.setItem(m, n, newitem)
-        self.waveTable.setHorizontalHeaderLabels(horHeaders)
+        # one tuple per wave, in the same order as the headers
+        rows = [(w.amplitude, w.duration, w.freq, w.shape) for w in self.wave_objects]
+        for m, row in enumerate(rows):
+            self.tableSetRow(m, row)
+        self.waveTable.setHorizontalHeaderLabels(['amplitude', 'duration', 'freq', 'shape'])
         self.waveTable.resizeColumnsToContents()
         self.waveTable.resizeRowsToContents()
+
+    def tableSetRow(self, m, row):
+        for n, val in enumerate(row):
+            self.waveTable.setItem(m, n, QTableWidgetItem(str(val)))
         
 
         
 
 
 class MplCanvas(FigureCanvasQTAgg):
+    # seconds of the wave initially shown on the time axis
+    time_window = 0.025
 
     def __init__(self, parent=None, width=5, height=6, dpi=100):
         self.fig = Figure(figsize=(width, height), dpi=dpi)
         self.axes = self.fig.add_subplot(211)
         self.axes_fft = self.fig.add_subplot(212)
         self.setAxParams()
+        # persistent artists for the summed wave, its fft, and the individual waves when plotting all of them.
+        # the sum is drawn above the individual waves, which cycle through the rest of the color cycle
+        # the time axis artists are animated, they're drawn by _draw_animated on top of the cached background
+        self.sum_line, = self.axes.plot([], [], zorder=2.5, animated=True)
+        self.fft_line, = self.axes_fft.plot([], [])
+        colors = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+        self.wave_coll = LineCollection([], colors=colors[1:] + colors[:1], animated=True)
+        self.axes.add_collection(self.wave_coll)
         super(MplCanvas, self).__init__(self.fig)
+        # background of the time axis without its lines, recached after every full draw (including resizes)
+        self._bg = None
+        self.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        # saving the figure draws it again, sometimes through another canvas. the lines still belong in the saved
+        # file, but that render isn't the on screen background, so it's not cached
+        if event.canvas is not self or self.is_saving():
+            for artist in (self.wave_coll, self.sum_line):
+                artist.draw(event.renderer)
+            return
+        self._bg = self.copy_from_bbox(self.axes.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        self.axes.draw_artist(self.wave_coll)
+        self.axes.draw_artist(self.sum_line)
+
+    def blit_waves(self):
+        """
+        Repaints just the lines on the time axis over the cached background, rather than redrawing the whole figure.
+        Falls back to a full draw if there's no background yet.
+        """
+        if self._bg is None:
+            self.draw_idle()
+            return
+        self.restore_region(self._bg)
+        self._draw_animated()
+        self.blit(self.axes.bbox)
 
     def setAxParams(self):
         self.axes.set_ylim(-2, 2)
-        self.axes.set_xlim(0,0.025)
+        self.axes.set_xlim(0, self.time_window)
         self.axes.set_title("Current Wave")
         self.axes.set_ylabel("Level")
         self.axes.set_xlabel("Time (seconds)")
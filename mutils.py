@@ -1,8 +1,24 @@
-import sys
+import math
+import wave
 import numpy as np
-from scipy import signal
+from scipy.fft import rfft, rfftfreq, next_fast_len
 from dataclasses import dataclass
-import pathlib
+
+#numba is optional. when it's installed the wave generators are jit compiled, otherwise the NumPy versions are used
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+#cupy is optional as well. when it's installed and there's a gpu, long ffts are done on the gpu with cuFFT
+try:
+    import cupy as cp
+    cp.cuda.runtime.getDeviceCount()
+except Exception:
+    cp = None
+
+# below this many samples, copying to and from the gpu costs more than the faster fft saves
+GPU_FFT_MIN_SAMPLES = 2**18
 
 
 @dataclass
@@ -11,56 +27,160 @@ class WaveInfo:
     duration: int
     freq: float
     amplitude: float
-    
+
+    def __post_init__(self):
+        self._cache = None
+        self._cache_key = None
+
     def gen_wave(self, rate):
+        """
+        Returns the wave sampled at rate. The result is cached and reused until rate or one of the fields changes,
+        so it is marked read-only.
+        """
+        key = (rate, self.shape, self.duration, self.freq, self.amplitude)
+        if self._cache_key != key:
+            # the samples are stored as float32, which is plenty for 24 bit audio and halves the memory every pass
+            # over the wave moves. the phase is still worked out in float64, see gen_wave_into
+            self._cache = self.gen_wave_into(rate, np.empty(self.duration*rate, dtype=np.float32))
+            self._cache.flags.writeable = False
+            self._cache_key = key
+        return self._cache
+
+    def gen_wave_into(self, rate, out):
+        """
+        Writes the wave sampled at rate, starting from t=0, into out and returns out. The phase is computed in
+        float64 whatever the dtype of out, since float32 times lose whole percents of amplitude at high
+        frequencies and long durations.
+        """
+        if njit is not None:
+            waveGens = {'sine': _sine_kernel, 'sawtooth': _saw_kernel, 'square': _sq_kernel, 'triangle': _tri_kernel}
+            return waveGens[self.shape](self.freq, rate, self.amplitude, out)
         waveGens = {'sine': genSine, 'sawtooth': genSawtooth, 'square':  genSquare, 'triangle':  genTriangle}
-        t = np.linspace(0, self.duration, self.duration*rate, endpoint=False)
-        return np.multiply(waveGens[self.shape](self.freq, t), self.amplitude)
-    
-    def get_kv_dict(self):
-        return {'shape': self.shape, 'duration': self.duration, 'freq': self.freq, 'amplitude': self.amplitude}
+        t = np.arange(out.shape[0]) / rate
+        return waveGens[self.shape](self.freq, t, self.amplitude, out=out)
 
-def genSine(freq, t):
-    return np.sin(2*np.pi*freq*t)
+def genSine(freq, t, amplitude=1.0, out=None):
+    # the phase is reduced to a fraction of a period before taking the sine, so large t don't cost precision
+    phase = _phase(freq, t)
+    phase *= 2*np.pi
+    np.sin(phase, out=phase)
+    return np.multiply(phase, amplitude, out=out)
 
 
-def genTriangle(freq, t):
-    return signal.sawtooth(2 * np.pi * freq * t, 0.5)
+def genTriangle(freq, t, amplitude=1.0, out=None):
+    # rises from -amplitude to amplitude over the first half of each period and falls back over the second half
+    phase = _phase(freq, t)
+    phase *= 2
+    phase -= 1
+    np.abs(phase, out=phase)
+    out = np.multiply(phase, -2*amplitude, out=out)
+    out += amplitude
+    return out
 
 
-def genSawtooth(freq, t):
-    return signal.sawtooth(2 * np.pi * freq * t)
+def genSawtooth(freq, t, amplitude=1.0, out=None):
+    out = np.multiply(_phase(freq, t), 2*amplitude, out=out)
+    out -= amplitude
+    return out
 
 
-def genSquare(freq, t):
-    return signal.square(2 * np.pi * freq * t)
+def genSquare(freq, t, amplitude=1.0, out=None):
+    out = np.multiply(_phase(freq, t) < 0.5, 2*amplitude, out=out)
+    out -= amplitude
+    return out
 
-def get_fft(sampFreq, sound):
-    sound = sound / 2.0**31
-    length_in_s = sound.shape[0] / sampFreq
-    time = np.arange(sound.shape[0]) / sound.shape[0] * length_in_s
-    signal = sound[:]
-    fft_spectrum = np.fft.rfft(signal)
-    freq = np.fft.rfftfreq(signal.size, d=1./sampFreq)
-    fft_spectrum_abs = np.abs(fft_spectrum)
-    return freq, fft_spectrum_abs
+def _phase(freq, t):
+    """
+    Returns how far through its current period the wave is at each t, as a float64 fraction in [0, 1).
+    """
+    phase = np.multiply(t, freq, dtype=np.float64)
+    np.mod(phase, 1.0, out=phase)
+    return phase
 
-def get_datadir() -> pathlib.Path:
+if njit is not None:
+    # single pass versions of the generators above. they work out the phase from the sample index in float64
+    # rather than reading a time array, and out is required here
 
-    """
-    Returns a parent directory path
-    where persistent application data can be stored.
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _sine_kernel(freq, rate, amplitude, out):
+        for i in prange(out.shape[0]):
+            p = freq*i/rate
+            p -= math.floor(p)
+            out[i] = amplitude*math.sin(2*math.pi*p)
+        return out
 
-    # linux: ~/.local/share
-    # macOS: ~/Library/Application Support
-    # windows: C:/Users/<USER>/AppData/Roaming
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _saw_kernel(freq, rate, amplitude, out):
+        for i in prange(out.shape[0]):
+            p = freq*i/rate
+            p -= math.floor(p)
+            out[i] = amplitude*(2*p - 1)
+        return out
+
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _sq_kernel(freq, rate, amplitude, out):
+        for i in prange(out.shape[0]):
+            p = freq*i/rate
+            p -= math.floor(p)
+            out[i] = amplitude*(1 - 2*(p >= 0.5))
+        return out
+
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _tri_kernel(freq, rate, amplitude, out):
+        for i in prange(out.shape[0]):
+            p = freq*i/rate
+            p -= math.floor(p)
+            out[i] = amplitude*(1 - 2*abs(2*p - 1))
+        return out
+
+def get_fft(sampFreq, sound, use_gpu=True):
+    # float32 is plenty for a 24 bit wave and halves the memory the transform has to move.
+    # the spectrum is scaled rather than the input as it's half the length
+    # a length with a large prime factor (a prime max_dur above 7, say) makes the fft fall back to a much slower
+    # algorithm, so the signal is zero padded up to the next length with only small prime factors. multiples of
+    # 44100 already are one and aren't padded. sound is always max_dur*rate long, so n (and the cached fft plan
+    # for it) stays the same between updates
+    n = next_fast_len(sound.shape[0])
+    if use_gpu and cp is not None and sound.shape[0] >= GPU_FFT_MIN_SAMPLES:
+        fft_spectrum_abs = cp.asnumpy(cp.abs(cp.fft.rfft(cp.asarray(sound, dtype=cp.float32), n=n)))
+    else:
+        fft_spectrum_abs = np.abs(rfft(sound.astype(np.float32, copy=False), n=n, workers=-1))
+    freq = rfftfreq(n, d=1./sampFreq)
+    fft_spectrum_abs /= 2.0**31
+    return freq, fft_spectrum_abs
+
+def write_wav24(path, rate, sound):
     """
+    Writes sound to path as a mono 24 bit .wav file. sound is scaled so that 1.0 is full scale, or down to fit
+    if it peaks above that.
+    """
+    scale = (2**23 - 1) / max(1.0, float(np.abs(sound).max()))
+    samples = np.rint(sound*scale).astype('<i4')
+    # keep the low three bytes of each little endian sample
+    raw = samples.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(3)
+        w.setframerate(rate)
+        w.writeframes(raw)
 
-    home = pathlib.Path.home()
+def aligned_empty(n, dtype=np.float64, align=64):
+    """
+    Returns an uninitialized array of n elements whose data starts on an align byte boundary.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = n*dtype.itemsize
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -raw.ctypes.data % align
+    return raw[offset:offset + nbytes].view(dtype)
 
-    if sys.platform == "win32":
-        return home / "AppData/Roaming/WavePlayground"
-    elif sys.platform == "linux":
-        return home / ".local/share/WavePlayground"
-    elif sys.platform == "darwin":
-        return home / "Library/Application Support/WavePlayground"
\ No newline at end of file
+def decimate_peaks(x, y, max_points=4096):
+    """
+    Reduces x and y to at most max_points for display. Keeps the largest y in each block rather than every
+    nth value so narrow peaks in y aren't dropped.
+    """
+    step = -(-y.shape[0] // max_points)
+    if step <= 1:
+        return x, y
+    starts = np.arange(0, y.shape[0], step)
+    return x[starts], np.maximum.reduceat(y, starts)